@@ -11,6 +11,7 @@ import shutil
 
 import healpy as hp
 import numpy as np
+import scipy.signal
 
 from ..timing import gather_timers, GlobalTimers
 from ..timing import dump as dump_timing
@@ -22,14 +23,98 @@ from ..todmap import (
     OpPointingHpix,
     OpMadam,
     OpMapMaker,
+    OpScanMask,
     OpSimScan,
 )
-from ..todmap.mapmaker import TemplateMatrix, OffsetTemplate, Signal
+from ..todmap.mapmaker import (
+    TemplateMatrix,
+    OffsetTemplate,
+    PCGSolver,
+    SubharmonicTemplate,
+    Signal,
+    convolve_kernel_fft,
+    get_kernel_fft,
+    legendre_templates,
+)
 from .. import qarray as qa
 
 from ._helpers import create_outdir, create_distdata, boresight_focalplane
 
 
+class DenseTemplate:
+    """ Stand-in template whose amplitudes are the signal itself
+    """
+
+    name = "dense"
+    comm = None
+
+    def __init__(self, namplitude):
+        self.namplitude = namplitude
+
+
+class DenseTemplateMatrix(TemplateMatrix):
+    """ Template matrix for a dense amplitude vector with a diagonal
+    preconditioner.  The signals are plain arrays.
+    """
+
+    def __init__(self, precond):
+        super().__init__(None, None, [DenseTemplate(precond.size)])
+        self.precond = precond
+
+    def apply(self, amplitudes):
+        return amplitudes.flatdata.copy()
+
+    def apply_transpose(self, signal):
+        amplitudes = self.zero_amplitudes()
+        amplitudes.flatdata[:] = signal
+        return amplitudes
+
+    def add_prior(self, amplitudes, new_amplitudes):
+        return
+
+    def apply_precond(self, amplitudes):
+        new_amplitudes = self.zero_amplitudes()
+        np.multiply(amplitudes.flatdata, self.precond, out=new_amplitudes.flatdata)
+        return new_amplitudes
+
+
+class DenseMatrix:
+    """ Dense symmetric matrix standing in for the noise or projection
+    matrix.  Counts its applications.
+    """
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.napply = 0
+
+    def apply(self, signal, in_place=False):
+        self.napply += 1
+        if in_place:
+            signal[:] = np.dot(self.matrix, signal)
+            return signal
+        return np.dot(self.matrix, signal)
+
+
+def pcg_reference(matrix, rhs, precond, niter):
+    """ Textbook PCG starting from a zero guess
+    """
+    x = np.zeros_like(rhs)
+    residual = rhs.copy()
+    precond_residual = precond * residual
+    proposal = precond_residual.copy()
+    sqsum = np.dot(residual, precond_residual)
+    for iiter in range(niter):
+        lhs_proposal = np.dot(matrix, proposal)
+        alpha = sqsum / np.dot(proposal, lhs_proposal)
+        x += alpha * proposal
+        residual -= alpha * lhs_proposal
+        precond_residual = precond * residual
+        last_sqsum = sqsum
+        sqsum = np.dot(residual, precond_residual)
+        proposal = precond_residual + sqsum / last_sqsum * proposal
+    return x
+
+
 class OpMapMakerTest(MPITestCase):
     def setUp(self):
         fixture_name = os.path.splitext(os.path.basename(__file__))[0]
@@ -343,6 +428,413 @@ class OpMapMakerTest(MPITestCase):
 
     """
 
+    def test_pcg_solver(self):
+        np.random.seed(12345)
+        n = 60
+        # Badly scaled symmetric positive definite system (condition number
+        # ~2e4) that the Jacobi preconditioner brings down to ~10
+        basis = np.linalg.qr(np.random.randn(n, n))[0]
+        core = np.dot(basis * np.logspace(0, 1, n), basis.T)
+        scale = np.logspace(0, 2, n)
+        matrix = scale[:, None] * core * scale[None, :]
+        precond = 1 / np.diag(matrix)
+        signal = np.random.randn(n)
+
+        for niter_max in 0, 1, 2, 5, 200:
+            for residual_replacement in 50, 3:
+                noise = DenseMatrix(matrix)
+                solver = PCGSolver(
+                    None,
+                    DenseTemplateMatrix(precond),
+                    noise,
+                    DenseMatrix(np.eye(n)),
+                    signal,
+                    niter_max=niter_max,
+                    convergence_limit=1e-24,
+                    residual_replacement=residual_replacement,
+                )
+                rhs = solver.rhs.flatdata.copy()
+                napply = noise.napply
+                solution = solver.solve().flatdata
+                if niter_max == 0:
+                    # No iterations, no updates and no applications of A
+                    np.testing.assert_array_equal(solution, np.zeros(n))
+                    self.assertEqual(noise.napply, napply)
+                elif niter_max < n:
+                    np.testing.assert_allclose(
+                        solution,
+                        pcg_reference(matrix, rhs, precond, niter_max),
+                        rtol=1e-10,
+                        atol=1e-10 * np.amax(np.abs(solution)),
+                    )
+                else:
+                    np.testing.assert_allclose(
+                        solution,
+                        np.linalg.solve(matrix, rhs),
+                        rtol=1e-8,
+                        atol=1e-8 * np.amax(np.abs(solution)),
+                    )
+
+        return
+
+    def test_pcg_solver_breakdown(self):
+        # An indefinite system whose first search direction has zero
+        # curvature, a non-finite system and a trivial one
+        matrix = np.array([[0.0, 1.0], [1.0, 0.0]])
+        for signal, error in (
+            (np.array([1.0, 0.0]), True),
+            (np.array([np.nan, 0.0]), True),
+            (np.zeros(2), False),
+        ):
+            solver = PCGSolver(
+                None,
+                DenseTemplateMatrix(np.ones(2)),
+                DenseMatrix(matrix),
+                DenseMatrix(np.eye(2)),
+                signal,
+                niter_max=10,
+                report_interval=3,
+            )
+            if error:
+                with self.assertRaises(RuntimeError):
+                    solver.solve()
+            else:
+                np.testing.assert_array_equal(solver.solve().flatdata, np.zeros(2))
+
+        return
+
+    def test_subharmonic_singular_preconditioner(self):
+        # Intervals shorter than the number of templates and fully flagged
+        # intervals have singular Gram matrices.  An interval with all but
+        # its first 0.5% flagged is singular to working precision.
+        order = 8
+        bounds = [
+            (0, 1),
+            (2, 4),
+            (5, 104),
+            (105, 9104),
+            (9105, self.totsamp - 1),
+        ]
+        for obs in self.data.obs:
+            obs["short_intervals"] = [
+                Interval(
+                    start=first / self.rate,
+                    stop=last / self.rate,
+                    first=first,
+                    last=last,
+                )
+                for first, last in bounds
+            ]
+            tod = obs["tod"]
+            for det in tod.local_dets:
+                tod.local_flags(det)[5:105] = 1
+                tod.local_flags(det)[150:9105] = 1
+
+        detweights = []
+        for obs in self.data.obs:
+            detweights.append({det: 1.0 for det in obs["tod"].local_dets})
+        template = SubharmonicTemplate(
+            self.data, detweights, order=order, intervals="short_intervals"
+        )
+
+        for (ind, iobs, det, todslice), preconditioner in zip(
+            template.templates, template.preconditioners
+        ):
+            tod = self.data.obs[iobs]["tod"]
+            good = (tod.local_flags(det)[todslice] & 1) == 0
+            good[(tod.local_common_flags()[todslice] & 1) != 0] = False
+            legendre = legendre_templates(todslice.stop - todslice.start, order)
+            legendre = legendre[:, good]
+            gram = np.dot(legendre, legendre.T)
+            self.assertTrue(np.all(np.isfinite(preconditioner)))
+            # The preconditioner must stay bounded even when the Gram matrix
+            # is singular to working precision
+            eps = np.finfo(np.float64).eps
+            gmax = np.amax(np.abs(gram), initial=1)
+            pmax = np.amax(np.abs(preconditioner))
+            self.assertLess(gmax * pmax, 1 / eps)
+            # The preconditioner must be a generalized inverse of the Gram
+            # matrix, up to rounding errors amplified by its size
+            np.testing.assert_allclose(
+                np.dot(gram, np.dot(preconditioner, gram)),
+                gram,
+                rtol=1e-10,
+                atol=max(1e-10, 100 * eps * gmax * pmax) * gmax,
+            )
+
+        return
+
+    def test_subharmonic_flagged_preconditioner(self):
+        # High order templates with heavy flagging are badly conditioned
+        order = 8
+        n = 9000
+        bounds = [
+            (0, n - 1),
+            (n, 2 * n - 1),
+            (2 * n, 3 * n - 1),
+            (3 * n, 4 * n - 1),
+            (4 * n, 4 * n + 1),
+            (4 * n + 2, 4 * n + 6),
+            (4 * n + 7, 5 * n),
+        ]
+        np.random.seed(12345)
+        for obs in self.data.obs:
+            obs["flagged_intervals"] = [
+                Interval(
+                    start=first / self.rate,
+                    stop=last / self.rate,
+                    first=first,
+                    last=last,
+                )
+                for first, last in bounds
+            ]
+            tod = obs["tod"]
+            for det in tod.local_dets:
+                flags = tod.local_flags(det)
+                # 49% and 30% flagged at the start of the interval
+                flags[: int(0.49 * n)] = 1
+                flags[n : n + int(0.3 * n)] = 1
+                # 45% randomly flagged
+                flags[2 * n : 3 * n][np.random.rand(n) < 0.45] = 1
+                # 60% flagged in the middle of the interval
+                flags[3 * n + int(0.2 * n) : 3 * n + int(0.8 * n)] = 1
+
+        detweight = 0.5
+        detweights = []
+        for obs in self.data.obs:
+            detweights.append({det: detweight for det in obs["tod"].local_dets})
+        template = SubharmonicTemplate(
+            self.data, detweights, order=order, intervals="flagged_intervals"
+        )
+
+        for (ind, iobs, det, todslice), preconditioner in zip(
+            template.templates, template.preconditioners
+        ):
+            tod = self.data.obs[iobs]["tod"]
+            good = (tod.local_flags(det)[todslice] & 1) == 0
+            good[(tod.local_common_flags()[todslice] & 1) != 0] = False
+            legendre = legendre_templates(todslice.stop - todslice.start, order)
+            # (T T^T)^+ = (T^+)^T T^+, without forming T T^T
+            pinv = np.linalg.pinv(legendre[:, good])
+            reference = np.dot(pinv.T, pinv) / detweight
+            np.testing.assert_allclose(
+                preconditioner,
+                reference,
+                rtol=0,
+                atol=1e-8 * np.amax(np.abs(reference)),
+            )
+
+        return
+
+    def test_convolve_kernel_fft(self):
+        np.random.seed(12345)
+        # Odd and even kernel lengths
+        for nkernel in 1, 2, 7, 8, 31, 64:
+            kernel = np.random.randn(nkernel)
+            # Kernels longer than the signal, a single block and overlap-add
+            for nsamp in 1, 3, nkernel, 8 * nkernel, 8 * nkernel + 1, 50 * nkernel + 3:
+                signal = np.random.randn(nsamp)
+                kernel_fft = get_kernel_fft(kernel, nsamp)
+                reference = scipy.signal.convolve(signal, kernel, mode="same")
+                np.testing.assert_allclose(
+                    convolve_kernel_fft(signal, kernel_fft),
+                    reference,
+                    rtol=1e-10,
+                    atol=1e-10 * np.amax(np.abs(reference)),
+                )
+
+        return
+
+    def test_offset_prior_filtering(self):
+        # The noise filters and C_a preconditioners are applied as
+        # pre-transformed kernels.  Compare against direct convolution.
+        detweights = []
+        for obs in self.data.obs:
+            detweights.append({det: 1.0 for det in obs["tod"].local_dets})
+        offset_template = OffsetTemplate(
+            self.data,
+            detweights,
+            step_length=1,
+            intervals="intervals",
+            use_noise_prior=True,
+            precond_width=1,
+        )
+        templates = TemplateMatrix(self.data, None, [offset_template])
+
+        amplitudes = templates.zero_amplitudes()
+        np.random.seed(12345)
+        amplitudes.flatdata[:] = np.random.randn(amplitudes.flatdata.size)
+        amps_in = amplitudes[offset_template.name]
+
+        def get_kernel(kernel_fft):
+            kernel_fft, nfft, nkernel, nblock = kernel_fft
+            return np.fft.irfft(kernel_fft, nfft)[:nkernel]
+
+        precond = templates.apply_precond(amplitudes)[offset_template.name]
+        prior = templates.zero_amplitudes()
+        templates.add_prior(amplitudes, prior)
+        prior = prior[offset_template.name]
+
+        for offsetslice, noisefilter, preconditioner in offset_template.prior_blocks:
+            np.testing.assert_allclose(
+                precond[offsetslice],
+                scipy.signal.convolve(
+                    amps_in[offsetslice], get_kernel(preconditioner), mode="same"
+                ),
+                rtol=1e-10,
+                atol=1e-10 * np.amax(np.abs(precond[offsetslice])),
+            )
+            np.testing.assert_allclose(
+                prior[offsetslice],
+                scipy.signal.convolve(
+                    amps_in[offsetslice], get_kernel(noisefilter), mode="same"
+                ),
+                rtol=1e-10,
+                atol=1e-10 * np.amax(np.abs(prior[offsetslice])),
+            )
+
+        return
+
+    def test_offset_step_indices(self):
+        detweights = []
+        for obs in self.data.obs:
+            detweights.append({det: 1.0 for det in obs["tod"].local_dets})
+        offset_template = OffsetTemplate(
+            self.data,
+            detweights,
+            step_length=1,
+            intervals="intervals",
+            use_noise_prior=False,
+        )
+
+        np.random.seed(12345)
+        nsamp = 10000
+        uniform = 10 + np.arange(nsamp) / self.rate
+        # Jittered sampling with a gap breaks the arithmetic guess and
+        # exercises the binary search
+        irregular = 10 + np.cumsum(np.random.uniform(0.5, 1.5, nsamp)) / self.rate
+        irregular[nsamp // 2 :] += 7.3
+        for times in uniform, irregular:
+            for first, last in (0, nsamp - 1), (123, 8765), (500, 500):
+                ival = Interval(
+                    start=times[first], stop=times[last], first=first, last=last
+                )
+                for step_length in 1, 0.37, 0.02:
+                    nbase = int(np.ceil((times[last] - times[first]) / step_length))
+                    start_times = np.arange(nbase) * step_length + ival.start
+                    indices = offset_template._get_step_indices(
+                        times, ival, start_times
+                    )
+                    np.testing.assert_array_equal(
+                        indices, np.searchsorted(times, start_times)
+                    )
+
+        return
+
+    def test_projection_matrix(self):
+        name = "testtod3"
+        init = OpCacheInit(name=name, init_val=0)
+        init.exec(self.data)
+
+        pointing = OpPointingHpix(
+            nside=self.map_nside, nest=True, mode=self.pointingmode
+        )
+        pointing.exec(self.data)
+
+        opnoise = OpSimNoise(realization=0, out=name)
+        opnoise.exec(self.data)
+
+        mapmaker = OpMapMaker(
+            nside=self.map_nside,
+            nnz=self.nnz,
+            name=name,
+            outdir=self.outdir,
+            outprefix="toast_projection_test_",
+            write_hits=False,
+            write_wcov_inv=False,
+            write_wcov=False,
+        )
+        mapmaker.comm = self.data.comm.comm_world
+        mapmaker.rank = self.rank
+        mapmaker.flag_gaps(self.data)
+        mapmaker.get_detweights(self.data)
+        mapmaker.initialize_binning(self.data)
+        projection = mapmaker.get_projectionmatrix(self.data)
+        signal = Signal(self.data, name=name)
+
+        # Applying the projection leaves the binned map of the input
+        # signal in dist_map
+        projection.bin_map(name)
+        binned = projection.dist_map.data.copy()
+        outputs = []
+        for _ in range(2):
+            outputs.append(projection.apply(signal))
+            np.testing.assert_array_equal(projection.dist_map.data, binned)
+        for obs in self.data.obs:
+            tod = obs["tod"]
+            for det in tod.local_dets:
+                np.testing.assert_array_equal(
+                    tod.local_signal(det, outputs[0].name),
+                    tod.local_signal(det, outputs[1].name),
+                )
+
+        return
+
+    def test_load_mask(self):
+        pointing = OpPointingHpix(
+            nside=self.map_nside, nest=True, mode=self.pointingmode
+        )
+        pointing.exec(self.data)
+
+        # Fractional, exactly 0.5, negative and NaN mask values
+        np.random.seed(12345)
+        maskmap = np.random.uniform(-0.5, 1.5, self.npix)
+        maskmap[::7] = 0.5
+        maskmap[::11] = np.nan
+        maskfile = os.path.join(self.outdir, "nan_mask.fits")
+        if self.rank == 0:
+            hp.write_map(
+                maskfile, maskmap, dtype=np.float32, overwrite=True, nest=True
+            )
+        if self.comm is not None:
+            self.comm.barrier()
+
+        mapmaker = OpMapMaker(
+            nside=self.map_nside,
+            nnz=self.nnz,
+            name="testtod4",
+            outdir=self.outdir,
+            maskfile=maskfile,
+        )
+        mapmaker.comm = self.data.comm.comm_world
+        mapmaker.rank = self.rank
+        flagmask = mapmaker.mask_bit
+
+        # Flags from the uint8 mask built by load_mask
+        mapmaker.load_mask(self.data)
+        uint8_flags = []
+        for obs in self.data.obs:
+            tod = obs["tod"]
+            for det in tod.local_dets:
+                flags = tod.local_flags(det)
+                uint8_flags.append(flags.copy())
+                flags &= ~np.uint8(flagmask)
+
+        # Flags from scanning the float mask
+        distmap = DistPixels(self.data, nnz=1, dtype=np.float32)
+        distmap.read_healpix_fits(maskfile)
+        scanmask = OpScanMask(distmap=distmap, flagmask=flagmask)
+        scanmask.exec(self.data)
+        ilocal = 0
+        for obs in self.data.obs:
+            tod = obs["tod"]
+            for det in tod.local_dets:
+                flags = tod.local_flags(det)
+                np.testing.assert_array_equal(flags, uint8_flags[ilocal])
+                ilocal += 1
+
+        return
+
     def test_mapmaker_madam(self):
 
         name = "testtod2"
@@ -2,16 +2,22 @@
 # All rights reserved.  Use of this source code is governed by
 # a BSD-style license that can be found in the LICENSE file.
 
-from ..mpi import use_mpi
+from concurrent.futures import ThreadPoolExecutor
+
+from ..mpi import use_mpi, MPI
 
 import numpy as np
 
 from .. import qarray as qa
 
+from .._libtoast import qa_to_angles
+
 from ..op import Operator
 
 from ..timing import function_timer, Timer
 
+from .sim_tod import TODHpixSpiral, TODSatellite, TODGround
+
 conviqt = None
 
 if use_mpi:
@@ -20,6 +26,15 @@ if use_mpi:
     except ImportError:
         pass
 
+# Detector pointing methods that simply rotate the boresight by the
+# detector offset quaternion.  For these TOD classes the boresight can be
+# read once per observation and shared by all detectors.
+_boresight_pointing = (
+    TODHpixSpiral._get_pntg,
+    TODSatellite._get_pntg,
+    TODGround._get_pntg,
+)
+
 
 class OpSimConviqt(Operator):
     """Operator which uses libconviqt to generate beam-convolved timestreams.
@@ -55,6 +70,11 @@ class OpSimConviqt(Operator):
             corrected for the polarization angle.
         out (str): the name of the cache object (<name>_<detector>) to
             use for output of the detector timestream.
+        prefetch (bool): Read the sky and beam of the next detector in a
+            background thread while the current detector is convolved.
+            Only used if MPI supports THREAD_MULTIPLE.  Peak memory then
+            holds two sets of sky and beam expansions, and libconviqt is
+            called from two threads at once.
 
     """
 
@@ -81,6 +101,7 @@ class OpSimConviqt(Operator):
         remove_dipole=False,
         normalize_beam=False,
         verbosity=0,
+        prefetch=False,
     ):
         # Call the parent class constructor
         super().__init__()
@@ -105,9 +126,23 @@ class OpSimConviqt(Operator):
         self._remove_dipole = remove_dipole
         self._normalize_beam = normalize_beam
         self._verbosity = verbosity
+        self._prefetch_next = prefetch
 
         self._out = out
 
+        # Sky and beam objects are cached by file name so that detectors
+        # sharing an expansion do not re-read it from disk.
+        self._sky_cache = {}
+        self._beam_cache = {}
+        # Boresight pointing and detector offsets, keyed by TOD
+        self._boresight_cache = {}
+        self._quat_scratch = None
+        self._angle_scratch = None
+        self._pnt = None
+        # Focalplane parameters, keyed by (id(focalplane), detector)
+        self._psipol_cache = {}
+        self._epsilon_cache = {}
+
     @property
     def available(self):
         """Return True if libconviqt is found in the library search path.
@@ -133,60 +168,163 @@ class OpSimConviqt(Operator):
 
         detectors = self._get_detectors(data)
 
-        for det in detectors:
-            verbose = self._comm.rank == 0 and self._verbosity > 0
+        sky_files = [self._get_sky_file(det) for det in detectors]
+        beam_files = [self._get_beam_file(det) for det in detectors]
+
+        # If requested and MPI allows concurrent calls from several threads,
+        # the sky and beam of the next detector are read in the background
+        # while the current detector is being convolved.  The reads use a
+        # duplicate communicator so they do not interfere with the
+        # convolution.
+        prefetch = (
+            self._prefetch_next
+            and len(detectors) > 1
+            and MPI.Query_thread() == MPI.THREAD_MULTIPLE
+        )
+        if prefetch:
+            pool = ThreadPoolExecutor(max_workers=1)
+            prefetch_comm = self._comm.Dup()
+        future = None
+
+        try:
+            for idet, det in enumerate(detectors):
+                verbose = self._comm.rank == 0 and self._verbosity > 0
 
-            try:
-                sky_file = self._sky_file[det]
-            except TypeError:
-                sky_file = self._sky_file.replace("DETECTOR", det)
-            sky = self.get_sky(sky_file, det, verbose)
+                if future is not None:
+                    # Wait for the prefetched expansions to land in the cache
+                    future.result()
+                    future = None
 
-            try:
-                beam_file = self._beam_file[det]
-            except TypeError:
-                beam_file = self._beam_file.replace("DETECTOR", det)
-            beam = self.get_beam(beam_file, det, verbose)
+                sky_file = sky_files[idet]
+                sky = self.get_sky(sky_file, det, verbose)
 
-            detector = self.get_detector(det)
+                beam_file = beam_files[idet]
+                beam = self.get_beam(beam_file, det, verbose)
 
-            theta, phi, psi = self.get_pointing(data, det, verbose)
-            pnt = self.get_buffer(theta, phi, psi, det, verbose)
-            del theta, phi, psi
+                if prefetch and idet + 1 < len(detectors):
+                    future = pool.submit(
+                        self._prefetch,
+                        sky_files[idet + 1],
+                        beam_files[idet + 1],
+                        detectors[idet + 1],
+                        prefetch_comm,
+                    )
 
-            convolved_data = self.convolve(sky, beam, detector, pnt, det, verbose)
+                detector = self.get_detector(det)
 
-            self.calibrate(data, det, beam, convolved_data, verbose)
-            self.cache(data, det, convolved_data, verbose)
+                theta, phi, psi = self.get_pointing(data, det, verbose)
+                pnt = self.get_buffer(theta, phi, psi, det, verbose)
+                del theta, phi, psi
 
-            del pnt, detector, beam, sky
+                convolved_data = self.convolve(sky, beam, detector, pnt, det, verbose)
 
-            if verbose:
-                timer.report_clear("conviqt process detector {}".format(det))
+                self.calibrate_and_cache(data, det, beam, convolved_data, verbose)
+
+                del pnt, detector, beam, sky
+
+                # Release the expansions that no remaining detector needs
+                if sky_file not in sky_files[idet + 1 :]:
+                    del self._sky_cache[sky_file]
+                if beam_file not in beam_files[idet + 1 :]:
+                    del self._beam_cache[beam_file]
+
+                if verbose:
+                    timer.report_clear("conviqt process detector {}".format(det))
+        finally:
+            if prefetch:
+                pool.shutdown(wait=True)
+                prefetch_comm.Free()
 
+        self.clear_cache()
+
+        return
+
+    def clear_cache(self):
+        """ Release all cached sky and beam expansions, boresight
+        pointing, pointing buffers and focalplane parameters.
+        """
+        self._sky_cache.clear()
+        self._beam_cache.clear()
+        self._boresight_cache.clear()
+        self._quat_scratch = None
+        self._angle_scratch = None
+        self._pnt = None
+        self._psipol_cache.clear()
+        self._epsilon_cache.clear()
+        return
+
+    def _prefetch(self, sky_file, beam_file, det, comm):
+        """ Load the sky and beam expansions for `det` into the cache.
+        """
+        self.get_sky(sky_file, det, False, comm=comm)
+        self.get_beam(beam_file, det, False, comm=comm)
         return
 
+    def _get_quats(self, tod, det):
+        """ Return the detector quaternions for `det`.
+
+        If the TOD class derives the detector pointing from the boresight
+        and the pointing is not already cached, the boresight is read only
+        once per observation and rotated into each detector frame.
+        Otherwise this falls back to `tod.local_pointing`.
+        """
+        if (
+            self._quat_name is None
+            and type(tod)._get_pntg in _boresight_pointing
+            and not tod.cache.exists("{}_{}".format(tod.POINTING_NAME, det))
+        ):
+            key = id(tod)
+            if key not in self._boresight_cache:
+                self._boresight_cache[key] = (tod.read_boresight(), tod.detoffset())
+            boresight, detoffset = self._boresight_cache[key]
+            return qa.mult(boresight, detoffset[det])
+        return tod.local_pointing(det, self._quat_name)
+
+    def _get_sky_file(self, det):
+        """ Resolve the sky file name for `det`.
+        """
+        try:
+            sky_file = self._sky_file[det]
+        except TypeError:
+            sky_file = self._sky_file.replace("DETECTOR", det)
+        return sky_file
+
+    def _get_beam_file(self, det):
+        """ Resolve the beam file name for `det`.
+        """
+        try:
+            beam_file = self._beam_file[det]
+        except TypeError:
+            beam_file = self._beam_file.replace("DETECTOR", det)
+        return beam_file
+
     def _get_detectors(self, data):
         """ Assemble a list of detectors across all processes and
         observations in `self._comm`.
+
+        The detectors are ordered by their total number of samples,
+        longest first, so the most expensive convolutions are scheduled
+        early.  Ties are broken by detector name.
         """
-        dets = set()
+        nsamples = {}
         for obs in data.obs:
             tod = obs["tod"]
             for det in tod.local_dets:
-                dets.add(det)
-        all_dets = self._comm.gather(dets, root=0)
-        if self._comm.rank == 0:
-            for some_dets in all_dets:
-                dets.update(some_dets)
-            dets = sorted(dets)
-        all_dets = self._comm.bcast(dets, root=0)
+                nsamples[det] = nsamples.get(det, 0) + tod.local_samples[1]
+        total_nsamples = {}
+        for some_nsamples in self._comm.allgather(nsamples):
+            for det, nsample in some_nsamples.items():
+                total_nsamples[det] = total_nsamples.get(det, 0) + nsample
+        all_dets = sorted(total_nsamples, key=lambda det: (-total_nsamples[det], det))
         return all_dets
 
     def _get_psipol(self, focalplane, det):
         """ Parse polarization angle in radians from the focalplane
         dictionary.
         """
+        key = (id(focalplane), det)
+        if key in self._psipol_cache:
+            return self._psipol_cache[key]
         if det not in focalplane:
             raise RuntimeError("focalplane does not include {}".format(det))
         if "pol_angle_deg" in focalplane[det]:
@@ -195,12 +333,16 @@ class OpSimConviqt(Operator):
             psipol = focalplane[det]["pol_angle_rad"]
         else:
             raise RuntimeError("focalplane[{}] does not include psi".format(det))
+        self._psipol_cache[key] = psipol
         return psipol
 
     def _get_epsilon(self, focalplane, det):
         """ Parse polarization leakage (epsilon) from the focalplane
         object or dictionary.
         """
+        key = (id(focalplane), det)
+        if key in self._epsilon_cache:
+            return self._epsilon_cache[key]
         if det not in focalplane:
             raise RuntimeError("focalplane does not include {}".format(det))
         if "pol_leakage" in focalplane[det]:
@@ -208,26 +350,37 @@ class OpSimConviqt(Operator):
         else:
             # Assume zero polarization leakage
             epsilon = 0
+        self._epsilon_cache[key] = epsilon
         return epsilon
 
-    def get_sky(self, skyfile, det, verbose):
+    def get_sky(self, skyfile, det, verbose, comm=None):
+        if skyfile in self._sky_cache:
+            return self._sky_cache[skyfile]
+        if comm is None:
+            comm = self._comm
         timer = Timer()
         timer.start()
-        sky = conviqt.Sky(self._lmax, self._pol, skyfile, self._fwhm, self._comm)
+        sky = conviqt.Sky(self._lmax, self._pol, skyfile, self._fwhm, comm)
         if self._remove_monopole:
             sky.remove_monopole()
         if self._remove_dipole:
             sky.remove_dipole()
+        self._sky_cache[skyfile] = sky
         if verbose:
             timer.report_clear("initialize sky for detector {}".format(det))
         return sky
 
-    def get_beam(self, beamfile, det, verbose):
+    def get_beam(self, beamfile, det, verbose, comm=None):
+        if beamfile in self._beam_cache:
+            return self._beam_cache[beamfile]
+        if comm is None:
+            comm = self._comm
         timer = Timer()
         timer.start()
-        beam = conviqt.Beam(self._lmax, self._beammmax, self._pol, beamfile, self._comm)
+        beam = conviqt.Beam(self._lmax, self._beammmax, self._pol, beamfile, comm)
         if self._normalize_beam:
             beam.normalize()
+        self._beam_cache[beamfile] = beam
         if verbose:
             timer.report_clear("initialize beam for detector {}".format(det))
         return beam
@@ -245,56 +398,91 @@ class OpSimConviqt(Operator):
         nullquat = np.array([0, 0, 0, 1], dtype=np.float64)
         timer = Timer()
         timer.start()
-        all_theta, all_phi, all_psi = [], [], []
-        for obs in data.obs:
+        local_obs = [obs for obs in data.obs if det in obs["tod"].local_dets]
+        all_nsample = [obs["tod"].local_samples[1] for obs in local_obs]
+        nsample_tot = sum(all_nsample)
+        # The quaternions of all observations are packed into a scratch
+        # buffer that is reused for every detector.
+        if self._quat_scratch is None or len(self._quat_scratch) < nsample_tot:
+            self._quat_scratch = np.empty([nsample_tot, 4], dtype=np.float64)
+        all_quats = self._quat_scratch[:nsample_tot]
+        all_psipol = []
+        offset = 0
+        for obs, nsample in zip(local_obs, all_nsample):
             tod = obs["tod"]
-            if det not in tod.local_dets:
-                continue
             focalplane = obs["focalplane"]
-            quats = tod.local_pointing(det, self._quat_name)
+            quats = all_quats[offset : offset + nsample]
+            quats[:] = self._get_quats(tod, det)
             if verbose:
                 timer.report_clear("get detector pointing for {}".format(det))
 
             if self._apply_flags:
                 common = tod.local_common_flags(self._common_flag_name)
                 flags = tod.local_flags(det, self._flag_name)
-                common = common & self._common_flag_mask
-                flags = flags & self._flag_mask
-                totflags = np.copy(flags)
-                totflags |= common
-                quats = quats.copy()
-                quats[totflags != 0] = nullquat
+                totflags = (flags & self._flag_mask) | (common & self._common_flag_mask)
+                # Masked select instead of a boolean scatter, so the cost
+                # does not depend on the flag density
+                np.copyto(quats, nullquat, where=(totflags != 0)[:, np.newaxis])
                 if verbose:
                     timer.report_clear("initialize flags for detector {}".format(det))
 
-            theta, phi, psi = qa.to_angles(quats)
             # Is the beam in Pxx or Dxx? Pxx will include the
             # detector polarization angle, Dxx will not.
             if self._dxx:
-                psipol = self._get_psipol(focalplane, det)
-                psi -= psipol
-            all_theta.append(theta)
-            all_phi.append(phi)
-            all_psi.append(psi)
-        if len(all_theta) > 0:
-            all_theta = np.hstack(all_theta)
-            all_phi = np.hstack(all_phi)
-            all_psi = np.hstack(all_psi)
+                all_psipol.append(self._get_psipol(focalplane, det))
+            else:
+                all_psipol.append(0)
+            offset += nsample
+        if len(local_obs) > 0:
+            # Translate all observations in a single call, writing the
+            # angles into rows of a reusable output buffer
+            if (
+                self._angle_scratch is None
+                or self._angle_scratch.shape[1] != nsample_tot
+            ):
+                self._angle_scratch = np.empty([3, nsample_tot], dtype=np.float64)
+            all_theta, all_phi, all_psi = self._angle_scratch
+            qa_to_angles(all_quats.reshape(-1), all_theta, all_phi, all_psi, False)
+            if self._dxx:
+                # The polarization angle is a per-detector constant, so it
+                # can usually be removed without a per-sample offset vector
+                if all_psipol.count(all_psipol[0]) == len(all_psipol):
+                    all_psi -= all_psipol[0]
+                else:
+                    offset = 0
+                    for psipol, nsample in zip(all_psipol, all_nsample):
+                        all_psi[offset : offset + nsample] -= psipol
+                        offset += nsample
+        else:
+            all_theta, all_phi, all_psi = [], [], []
         if verbose:
             timer.report_clear("compute pointing angles for detector {}".format(det))
         return all_theta, all_phi, all_psi
 
     def get_buffer(self, theta, phi, psi, det, verbose):
         """Pack the pointing into the conviqt pointing array
+
+        The pointing array is kept and reused for the next detector
+        if the sample count does not change.
         """
         timer = Timer()
         timer.start()
-        pnt = conviqt.Pointing(len(theta))
+        nsample = len(theta)
+        if self._pnt is not None and self._pnt._nrow == nsample:
+            pnt = self._pnt
+            reused = True
+        else:
+            self._pnt = None
+            pnt = conviqt.Pointing(nsample)
+            self._pnt = pnt
+            reused = False
         if pnt._nrow > 0:
             arr = pnt.data()
-            arr[:, 0] = phi
-            arr[:, 1] = theta
-            arr[:, 2] = psi
+            # Interleave the angles straight into the first three columns
+            np.stack([phi, theta, psi], axis=1, out=arr[:, :3])
+            if reused:
+                # Clear the output of the previous detector
+                arr[:, 3:] = 0
         if verbose:
             timer.report_clear("pack input array for detector {}".format(det))
         return pnt
@@ -332,48 +520,43 @@ class OpSimConviqt(Operator):
 
         return convolved_data
 
-    def calibrate(self, data, det, beam, convolved_data, verbose):
-        """ By default, libConviqt results returns a signal that conforms to
+    def calibrate_and_cache(self, data, det, beam, convolved_data, verbose):
+        """ Calibrate the convolved data and inject it into the TOD cache.
+
+        By default, libConviqt results returns a signal that conforms to
         TOD = (1 + epsilon) / 2 * intensity + (1 - epsilon) / 2 * polarization.
 
         When calibrate = True, we rescale the TOD to
         TOD = intensity + (1 - epsilon) / (1 + epsilon) * polarization
-        """
-        if not self._calibrate or beam.normalized():
-            return
-        timer = Timer()
-        timer.start()
-        offset = 0
-        for obs in data.obs:
-            tod = obs["tod"]
-            if det not in tod.local_dets:
-                continue
-            focalplane = obs["focalplane"]
-            epsilon = self._get_epsilon(focalplane, det)
-            nsample = tod.local_samples[1]
-            convolved_data[offset : offset + nsample] *= 2 / (1 + epsilon)
-            offset += nsample
-        if verbose:
-            timer.report_clear("calibrate detector {}".format(det))
-        return
 
-    def cache(self, data, det, convolved_data, verbose):
-        """ Inject the convolved data into the TOD cache.
+        Both steps are done in the same pass over each observation.
         """
         timer = Timer()
         timer.start()
+        calibrate = self._calibrate and not beam.normalized()
         offset = 0
         for obs in data.obs:
             tod = obs["tod"]
             if det not in tod.local_dets:
                 continue
             nsample = tod.local_samples[1]
+            chunk = convolved_data[offset : offset + nsample]
+            scale = 1
+            if calibrate:
+                focalplane = obs["focalplane"]
+                epsilon = self._get_epsilon(focalplane, det)
+                scale = 2 / (1 + epsilon)
             cachename = "{}_{}".format(self._out, det)
-            if not tod.cache.exists(cachename):
-                tod.cache.create(cachename, np.float64, (nsample,))
-            ref = tod.cache.reference(cachename)
-            ref[:] += convolved_data[offset : offset + nsample]
+            if tod.cache.exists(cachename):
+                ref = tod.cache.reference(cachename)
+                if calibrate:
+                    chunk *= scale
+                ref[:] += chunk
+            else:
+                # A new buffer is only written, never read back
+                ref = tod.cache.create(cachename, np.float64, (nsample,))
+                np.multiply(chunk, scale, out=ref)
             offset += nsample
         if verbose:
-            timer.report_clear("cache detector {}".format(det))
+            timer.report_clear("calibrate and cache detector {}".format(det))
         return
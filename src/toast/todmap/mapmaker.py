@@ -1,10 +1,12 @@
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+import math
 import os
 import sys
 
 import numpy as np
+import scipy.fftpack
 import scipy.linalg
-import scipy.signal
+import scipy.linalg.blas
 
 from toast import Operator
 from toast.mpi import MPI
@@ -37,6 +39,107 @@ def free_temporary_name(name):
     temporary_names.remove(name)
 
 
+def legendre_templates(nsamp, order):
+    """ Return the Legendre polynomials up to `order` evaluated on
+    `nsamp` evenly spaced points across [-1, 1].
+    """
+    r = np.linspace(-1, 1, nsamp)
+    return np.polynomial.legendre.legvander(r, order).T.copy()
+
+
+def invert_gram(templates):
+    """ Return the inverse of the Gram matrix of the rows of `templates`.
+
+    The inverse is built from the column pivoted QR factorization of the
+    templates so that their condition number is not squared.  If the
+    templates are numerically rank deficient, the pseudoinverse is
+    returned instead.
+    """
+    norder, nsamp = templates.shape
+    if nsamp >= norder:
+        r, pivots = scipy.linalg.qr(templates.T, mode="r", pivoting=True)
+        r = r[:norder]
+        # Pivoting sorts the diagonal of R by decreasing magnitude and the
+        # last element estimates the smallest singular value.  Beyond this
+        # limit the Gram matrix is singular to working precision.
+        rcond = np.sqrt(np.finfo(np.float64).eps)
+        if np.abs(r[-1, -1]) > np.abs(r[0, 0]) * rcond:
+            rinv = scipy.linalg.solve_triangular(r, np.eye(norder))
+            invgram = np.empty([norder, norder])
+            invgram[np.ix_(pivots, pivots)] = np.dot(rinv, rinv.T)
+            return invgram
+    return scipy.linalg.pinvh(np.dot(templates, templates.T))
+
+
+def interpolate_log_psd(x, logfreq, logpsd):
+    """ Interpolate a PSD in log-log space.  The PSD is zero at
+    vanishing frequencies.
+    """
+    result = np.zeros(x.size)
+    absx = np.abs(x)
+    good = absx > 1e-10
+    result[good] = np.exp(np.interp(np.log(absx[good]), logfreq, logpsd))
+    return result
+
+
+def get_kernel_fft(kernel, nsamp):
+    """ Return the zero-padded real FFT of `kernel` for convolving it
+    with `nsamp` samples without wrap-around.
+
+    Signals much longer than the kernel are convolved in overlapping
+    blocks (overlap-add) so the FFT length scales with the kernel.
+    The result is a tuple to be passed to `convolve_kernel_fft`.
+    """
+    nkernel = kernel.size
+    if nsamp > 8 * nkernel:
+        nfft = scipy.fftpack.next_fast_len(8 * nkernel)
+        nblock = nfft - nkernel + 1
+    else:
+        nfft = scipy.fftpack.next_fast_len(nsamp + nkernel - 1)
+        nblock = nsamp
+    return np.fft.rfft(kernel, n=nfft), nfft, nkernel, nblock
+
+
+def convolve_kernel_fft(signal, kernel_fft):
+    """ Convolve `signal` with a kernel pre-transformed by
+    `get_kernel_fft`.  Equivalent to
+    `scipy.signal.convolve(signal, kernel, mode="same")`.
+    """
+    kernel_fft, nfft, nkernel, nblock = kernel_fft
+    nsamp = signal.size
+    nchunk = -(-nsamp // nblock)
+    padded = np.zeros(nchunk * nblock)
+    padded[:nsamp] = signal
+    chunks = np.fft.irfft(
+        np.fft.rfft(padded.reshape([nchunk, nblock]), n=nfft) * kernel_fft, n=nfft
+    )
+    if nchunk == 1:
+        full = chunks[0]
+    else:
+        # Overlap-add the chunks.  The blocks are longer than the kernel
+        # so each tail only overlaps the next block.
+        full = np.zeros((nchunk + 1) * nblock)
+        full[: nchunk * nblock] = chunks[:, :nblock].ravel()
+        ntail = nkernel - 1
+        full[nblock:].reshape([nchunk, nblock])[:, :ntail] += chunks[
+            :, nblock : nblock + ntail
+        ]
+    istart = (nkernel - 1) // 2
+    return full[istart : istart + nsamp]
+
+
+def inplace_axpy(y, alpha, x):
+    """ Compute y += alpha * x in a single pass without temporaries.
+    """
+    if y.size == 0:
+        return y
+    result = scipy.linalg.blas.daxpy(x, y, a=alpha)
+    if result is not y:
+        # BLAS had to work on a copy
+        y[:] = result
+    return y
+
+
 class TOASTMatrix:
     def apply(self, vector, inplace=False):
         """ Every TOASTMatrix can apply itself to a distributed vectors
@@ -110,6 +213,8 @@ class SubharmonicTemplate(TODTemplate):
     """
 
     name = "subharmonic"
+    # Number of interval lengths to keep Legendre templates for
+    max_cached_lengths = 16
 
     def __init__(
         self,
@@ -130,16 +235,17 @@ class SubharmonicTemplate(TODTemplate):
         self.common_flag_mask = common_flag_mask
         self.flags = flags
         self.flag_mask = flag_mask
-        self._last_nsamp = None
-        self._last_templates = None
+        # Legendre templates and their Gram matrices keyed by interval
+        # length.  They belong to this object so they are released with it.
+        self._legendre_templates = OrderedDict()
+        self._legendre_grams = {}
         self.get_steps_and_preconditioner()
 
     def get_steps_and_preconditioner(self):
         """ Assign each template an amplitude
         """
         self.templates = []
-        self.slices = []
-        self.preconditioners = []
+        preconditioners = []
         for iobs, obs in enumerate(self.data.obs):
             tod = obs["tod"]
             common_flags = tod.local_common_flags(self.common_flags)
@@ -149,8 +255,6 @@ class SubharmonicTemplate(TODTemplate):
             else:
                 intervals = None
             local_intervals = tod.local_intervals(intervals)
-            slices = {}  # this observation
-            preconditioners = {}  # this observation
             for ival in local_intervals:
                 todslice = slice(ival.first, ival.last + 1)
                 for idet, det in enumerate(tod.local_dets):
@@ -160,13 +264,13 @@ class SubharmonicTemplate(TODTemplate):
                     preconditioner = self._get_preconditioner(
                         det, tod, todslice, common_flags, self.detweights[iobs][det]
                     )
-                    if det not in preconditioners:
-                        preconditioners[det] = []
-                        slices[det] = []
-                    preconditioners[det].append(preconditioner)
-                    slices[det].append(ind)
-            self.slices.append(slices)
-            self.preconditioners.append(preconditioners)
+                    preconditioners.append(preconditioner)
+        # The amplitudes of consecutive templates are contiguous, so the
+        # preconditioner blocks can be stacked and applied in one call.
+        norder = self.order + 1
+        self.preconditioners = np.array(preconditioners).reshape([-1, norder, norder])
+        # The Gram matrices are only needed for the preconditioners
+        self._legendre_grams.clear()
         return
 
     def _get_preconditioner(self, det, tod, todslice, common_flags, detweight):
@@ -175,27 +279,39 @@ class SubharmonicTemplate(TODTemplate):
         flags = tod.local_flags(det, self.flags)[todslice]
         good = (flags & self.flag_mask) == 0
         good[common_flags[todslice]] = False
+        nsamp = todslice.stop - todslice.start
+        nbad = nsamp - np.count_nonzero(good)
         norder = self.order + 1
-        preconditioner = np.zeros([norder, norder])
-        templates = self._get_templates(todslice)
-        for row in range(norder):
-            for col in range(row, norder):
-                preconditioner[row, col] = np.dot(
-                    templates[row][good], templates[col][good]
-                )
-                preconditioner[row, col] *= detweight
-                if row != col:
-                    preconditioner[col, row] = preconditioner[row, col]
-        preconditioner = np.linalg.inv(preconditioner)
+        preconditioner = None
+        if nbad < nsamp // 2:
+            # Most samples are good: remove the flagged samples from
+            # the cached Gram matrix of the full interval
+            gram = self._get_gram(nsamp).copy()
+            if nbad > 0:
+                templates = self._get_templates(todslice)[:, np.logical_not(good)]
+                gram -= np.dot(templates, templates.T)
+            # The subtraction and the Cholesky inverse are only accurate
+            # while the Gram matrix is well conditioned
+            if np.linalg.cond(gram) < 1e6:
+                gram *= detweight
+                try:
+                    preconditioner = scipy.linalg.cho_solve(
+                        scipy.linalg.cho_factor(gram), np.eye(norder)
+                    )
+                except scipy.linalg.LinAlgError:
+                    preconditioner = None
+        if preconditioner is None:
+            # Heavily flagged, short or badly conditioned interval
+            templates = self._get_templates(todslice)[:, good]
+            preconditioner = invert_gram(templates * np.sqrt(detweight))
         return preconditioner
 
     def add_to_signal(self, signal, amplitudes):
         subharmonic_amplitudes = amplitudes[self.name]
-        for ibase, (ind, iobs, det, todslice) in enumerate(self.templates):
+        for ind, iobs, det, todslice in self.templates:
             templates = self._get_templates(todslice)
             amps = subharmonic_amplitudes[ind]
-            for template, amplitude in zip(templates, amps):
-                signal[iobs, det, todslice] += template * amplitude
+            signal[iobs, det, todslice] += np.dot(amps, templates)
         return
 
     def _get_templates(self, todslice):
@@ -204,47 +320,45 @@ class SubharmonicTemplate(TODTemplate):
         The basis functions are (orthogonal) Legendre polynomials
         """
         nsamp = todslice.stop - todslice.start
-        if nsamp != self._last_nsamp:
-            templates = np.zeros([self.order + 1, nsamp])
-            r = np.linspace(-1, 1, nsamp)
-            for order in range(self.order + 1):
-                if order == 0:
-                    templates[order] = 1
-                elif order == 1:
-                    templates[order] = r
-                else:
-                    templates[order] = (
-                        (2 * order - 1) * r * templates[order - 1]
-                        - (order - 1) * templates[order - 2]
-                    ) / order
-            self._last_nsamp = nsamp
-            self._last_templates = templates
-        return self._last_templates
+        if nsamp in self._legendre_templates:
+            self._legendre_templates.move_to_end(nsamp)
+        else:
+            if len(self._legendre_templates) == self.max_cached_lengths:
+                self._legendre_templates.popitem(last=False)
+            templates = legendre_templates(nsamp, self.order)
+            # The templates are shared between callers
+            templates.flags.writeable = False
+            self._legendre_templates[nsamp] = templates
+        return self._legendre_templates[nsamp]
+
+    def _get_gram(self, nsamp):
+        """ Return the Gram matrix of the templates of the given length
+        """
+        if nsamp not in self._legendre_grams:
+            templates = self._get_templates(slice(0, nsamp))
+            self._legendre_grams[nsamp] = np.dot(templates, templates.T)
+        return self._legendre_grams[nsamp]
 
     def project_signal(self, signal, amplitudes):
         subharmonic_amplitudes = amplitudes[self.name]
-        for ibase, (ind, iobs, det, todslice) in enumerate(self.templates):
+        for ind, iobs, det, todslice in self.templates:
             templates = self._get_templates(todslice)
-            amps = subharmonic_amplitudes[ind]
-            for order, template in enumerate(templates):
-                amps[order] = np.dot(signal[iobs, det, todslice], template)
-        pass
+            subharmonic_amplitudes[ind] = np.dot(templates, signal[iobs, det, todslice])
+        return
 
     def apply_precond(self, amplitudes_in, amplitudes_out):
         """ Standard diagonal preconditioner accounting for the fact that
         the templates are not orthogonal in the presence of flagging and masking
         """
-        subharmonic_amplitudes_in = amplitudes_in[self.name]
-        subharmonic_amplitudes_out = amplitudes_out[self.name]
-        for iobs, obs in enumerate(self.data.obs):
-            tod = obs["tod"]
-            for det in tod.local_dets:
-                slices = self.slices[iobs][det]
-                preconditioners = self.preconditioners[iobs][det]
-                for ind, preconditioner in zip(slices, preconditioners):
-                    subharmonic_amplitudes_out[ind] = np.dot(
-                        preconditioner, subharmonic_amplitudes_in[ind]
-                    )
+        norder = self.order + 1
+        subharmonic_amplitudes_in = amplitudes_in[self.name].reshape([-1, norder])
+        subharmonic_amplitudes_out = amplitudes_out[self.name].reshape([-1, norder])
+        np.einsum(
+            "kij,kj->ki",
+            self.preconditioners,
+            subharmonic_amplitudes_in,
+            out=subharmonic_amplitudes_out,
+        )
         return
 
 
@@ -288,13 +402,15 @@ class OffsetTemplate(TODTemplate):
         for every detector and every observation
         """
         log = Logger.get()
-        self.filters = []  # all observations
-        self.preconditioners = []  # all observations
+        # One (amplitude slice, filter, preconditioner) block for every
+        # interval of every detector and observation, flattened so the
+        # PCG iterations do not need to walk the observations
+        self.prior_blocks = []
         for iobs, obs in enumerate(self.data.obs):
             if "noise" not in obs:
                 # If the observations do not include noise PSD:s, we
                 # we cannot build filters.
-                if len(self.filters) > 0:
+                if len(self.prior_blocks) > 0:
                     log.warning(
                         'Observation "{}" does not have noise information'
                         "".format(obs["name"])
@@ -313,19 +429,18 @@ class OffsetTemplate(TODTemplate):
             freq = np.logspace(powmin, powmax, 1000)
             # Now build the filter for each detector
             noise = obs["noise"]
-            noisefilters = {}  # this observation
-            preconditioners = {}  # this observation
             for det in tod.local_dets:
                 offset_psd = self._get_offset_psd(noise, freq, det)
-                # Store real space filters for every interval and every detector.
+                # Store filters for every interval and every detector.
+                slices = self.offset_slices[iobs][det]
                 (
-                    noisefilters[det],
-                    preconditioners[det],
-                ) = self._get_noisefilter_and_preconditioner(
-                    freq, offset_psd, self.offset_slices[iobs][det]
-                )
-            self.filters.append(noisefilters)
-            self.preconditioners.append(preconditioners)
+                    noisefilters,
+                    preconditioners,
+                ) = self._get_noisefilter_and_preconditioner(freq, offset_psd, slices)
+                for (offsetslice, sigmasqs), noisefilter, preconditioner in zip(
+                    slices, noisefilters, preconditioners
+                ):
+                    self.prior_blocks.append((offsetslice, noisefilter, preconditioner))
         return
 
     @function_timer
@@ -334,9 +449,9 @@ class OffsetTemplate(TODTemplate):
         psd = noise.psd(det)
         rate = noise.rate(det)
         # Remove the white noise component from the PSD
-        psd = psd.copy() * np.sqrt(rate)
+        psd = psd * np.sqrt(rate)
         psd -= np.amin(psd[psdfreq > 1.0])
-        psd[psd < 1e-30] = 1e-30
+        np.maximum(psd, 1e-30, out=psd)
 
         # The calculation of `offset_psd` is from Keihänen, E. et al:
         # "Making CMB temperature and polarization maps with Madam",
@@ -344,28 +459,17 @@ class OffsetTemplate(TODTemplate):
         logfreq = np.log(psdfreq)
         logpsd = np.log(psd)
 
-        def interpolate_psd(x):
-            result = np.zeros(x.size)
-            good = np.abs(x) > 1e-10
-            logx = np.log(np.abs(x[good]))
-            logresult = np.interp(logx, logfreq, logpsd)
-            result[good] = np.exp(logresult)
-            return result
-
-        def g(x):
-            bad = np.abs(x) < 1e-10
-            good = np.logical_not(bad)
-            arg = np.pi * x[good]
-            result = bad.astype(np.float64)
-            result[good] = (np.sin(arg) / arg) ** 2
-            return result
-
         tbase = self.step_length
         fbase = 1 / tbase
-        offset_psd = interpolate_psd(freq) * g(freq * tbase)
+        x = freq * tbase
+        # np.sinc(x) = sin(pi x) / (pi x)
+        offset_psd = interpolate_log_psd(freq, logfreq, logpsd) * np.sinc(x) ** 2
         for m in range(1, 2):
-            offset_psd += interpolate_psd(freq + m * fbase) * g(freq * tbase + m)
-            offset_psd += interpolate_psd(freq - m * fbase) * g(freq * tbase - m)
+            for sign in (1, -1):
+                offset_psd += (
+                    interpolate_log_psd(freq + sign * m * fbase, logfreq, logpsd)
+                    * np.sinc(x + sign * m) ** 2
+                )
         offset_psd *= fbase
         return offset_psd
 
@@ -373,15 +477,7 @@ class OffsetTemplate(TODTemplate):
     def _get_noisefilter_and_preconditioner(self, freq, offset_psd, offset_slices):
         logfreq = np.log(freq)
         logpsd = np.log(offset_psd)
-        logfilter = np.log(1 / offset_psd)
-
-        def interpolate(x, psd):
-            result = np.zeros(x.size)
-            good = np.abs(x) > 1e-10
-            logx = np.log(np.abs(x[good]))
-            logresult = np.interp(logx, logfreq, psd)
-            result[good] = np.exp(logresult)
-            return result
+        logfilter = -logpsd
 
         def truncate(noisefilter, lim=1e-4):
             icenter = noisefilter.size // 2
@@ -393,18 +489,41 @@ class OffsetTemplate(TODTemplate):
             noisefilter = noisefilter[icenter - icut : icenter + icut + 1]
             return noisefilter
 
+        # The filters only depend on the number of steps in the slice.
+        # Regular intervals share the same length so compute each
+        # filter once.
+        kernels = {}
+
+        def get_kernels(nstep):
+            if nstep not in kernels:
+                filterlen = nstep * 2 + 1
+                filterfreq = np.fft.rfftfreq(filterlen, self.step_length)
+                noisefilter = truncate(
+                    np.fft.irfft(interpolate_log_psd(filterfreq, logfreq, logfilter))
+                )
+                # The filters are applied in every iteration so store them
+                # already Fourier transformed
+                noisefilter_fft = get_kernel_fft(noisefilter, nstep)
+                if self.precond_width <= 1:
+                    # Compute C_a prior
+                    prior = truncate(
+                        np.fft.irfft(interpolate_log_psd(filterfreq, logfreq, logpsd))
+                    )
+                    prior_fft = get_kernel_fft(prior, nstep)
+                else:
+                    prior_fft = None
+                kernels[nstep] = (noisefilter, noisefilter_fft, prior_fft)
+            return kernels[nstep]
+
         noisefilters = []
         preconditioners = []
         for offset_slice, sigmasqs in offset_slices:
             nstep = offset_slice.stop - offset_slice.start
-            filterlen = nstep * 2 + 1
-            filterfreq = np.fft.rfftfreq(filterlen, self.step_length)
-            noisefilter = truncate(np.fft.irfft(interpolate(filterfreq, logfilter)))
-            noisefilters.append(noisefilter)
+            noisefilter, noisefilter_fft, prior_fft = get_kernels(nstep)
+            noisefilters.append(noisefilter_fft)
             # Build the band-diagonal preconditioner
             if self.precond_width <= 1:
-                # Compute C_a prior
-                preconditioner = truncate(np.fft.irfft(interpolate(filterfreq, logpsd)))
+                preconditioners.append(prior_fft)
             else:
                 # Compute Cholesky decomposition prior
                 wband = min(self.precond_width, noisefilter.size // 2)
@@ -419,15 +538,19 @@ class OffsetTemplate(TODTemplate):
                 scipy.linalg.cholesky_banded(
                     preconditioner, overwrite_ab=True, lower=lower, check_finite=True
                 )
-            preconditioners.append((preconditioner, lower))
+                preconditioners.append((preconditioner, lower))
         return noisefilters, preconditioners
 
     @function_timer
     def get_steps(self):
         """ Divide each interval into offset steps
         """
-        self.offset_templates = []
+        # Diagonal preconditioner, indexed by the amplitude number
+        offset_sigmasq = []
         self.offset_slices = []  # slices in all observations
+        # TOD slices and template indices grouped by observation and
+        # detector, ready for the compiled kernels
+        self.offset_groups = []
         for iobs, obs in enumerate(self.data.obs):
             tod = obs["tod"]
             common_flags = tod.local_common_flags(self.common_flags)
@@ -438,14 +561,16 @@ class OffsetTemplate(TODTemplate):
                 intervals = None
             local_intervals = tod.local_intervals(intervals)
             times = tod.local_times()
-            offset_slices = {}  # slices in this observation
+            offset_slices = defaultdict(list)  # slices in this observation
+            # kernel arguments in this observation
+            offset_groups = defaultdict(lambda: ([], []))
             for ival in local_intervals:
                 length = times[ival.last] - times[ival.first]
                 nbase = int(np.ceil(length / self.step_length))
                 # Divide the interval into steps, allowing for irregular sampling
                 todslices = []
                 start_times = np.arange(nbase) * self.step_length + ival.start
-                start_indices = np.searchsorted(times, start_times)
+                start_indices = self._get_step_indices(times, ival, start_times)
                 stop_indices = np.hstack([start_indices[1:], [ival.last]])
                 todslices = []
                 for istart, istop in zip(start_indices, stop_indices):
@@ -453,27 +578,64 @@ class OffsetTemplate(TODTemplate):
                 for idet, det in enumerate(tod.local_dets):
                     istart = self.namplitude
                     sigmasqs = []
+                    group_slices, group_templates = offset_groups[det]
                     for todslice in todslices:
                         sigmasq = self._get_sigmasq(
                             tod, det, todslice, common_flags, self.detweights[iobs][det]
                         )
                         # Register the baseline offset
-                        self.offset_templates.append(
-                            [self.namplitude, iobs, det, todslice, sigmasq]
-                        )
+                        offset_sigmasq.append(sigmasq)
                         sigmasqs.append(sigmasq)
+                        group_slices.append(todslice)
+                        group_templates.append(self.namplitude)
                         self.namplitude += 1
                     # Keep a record of ranges of offsets that correspond
                     # to one detector and one interval.
                     # This is the domain we apply the noise filter in.
-                    if det not in offset_slices:
-                        offset_slices[det] = []
                     offset_slices[det].append(
                         (slice(istart, self.namplitude), sigmasqs)
                     )
-            self.offset_slices.append(offset_slices)
+            self.offset_slices.append(dict(offset_slices))
+            for det, (todslices, itemplates) in offset_groups.items():
+                self.offset_groups.append(
+                    (iobs, det, todslices, np.array(itemplates, dtype=np.int64))
+                )
+        self._sigmasq = np.array(offset_sigmasq, dtype=np.float64)
         return
 
+    def _get_step_indices(self, times, ival, start_times):
+        """ Find the first sample at or after each step start time.
+
+        Regularly sampled intervals are indexed arithmetically and the
+        result is verified against the time stamps.  Irregular sampling
+        falls back to a binary search.
+        """
+        nsample = ival.last - ival.first
+        if nsample > 0:
+            dt = (times[ival.last] - times[ival.first]) / nsample
+        else:
+            dt = 0
+        if dt > 0:
+            guess = np.rint((start_times - times[ival.first]) / dt)
+            indices = ival.first + guess.astype(np.int64)
+            np.clip(indices, 0, times.size, out=indices)
+            # Step boundaries often coincide with samples.  Move the guesses
+            # by one sample to absorb rounding in the time stamps.
+            late = indices < times.size
+            late[late] = times[indices[late]] < start_times[late]
+            indices[late] += 1
+            early = indices > 0
+            early[early] = times[indices[early] - 1] >= start_times[early]
+            indices[early] -= 1
+            # Every index must satisfy times[i - 1] < t <= times[i]
+            before = indices - 1
+            after = np.minimum(indices, times.size - 1)
+            good_before = (before < 0) | (times[np.maximum(before, 0)] < start_times)
+            good_after = (indices == times.size) | (times[after] >= start_times)
+            if np.all(good_before & good_after):
+                return indices
+        return np.searchsorted(times, start_times)
+
     @function_timer
     def _get_sigmasq(self, tod, det, todslice, common_flags, detweight):
         """ calculate a rough estimate of the baseline variance
@@ -493,54 +655,18 @@ class OffsetTemplate(TODTemplate):
     @function_timer
     def add_to_signal(self, signal, amplitudes):
         offset_amplitudes = amplitudes[self.name]
-        last_obs = None
-        last_det = None
-        last_ref = None
-        todslices = []
-        itemplates = []
-        for itemplate, iobs, det, todslice, sigmasq in self.offset_templates:
-            if iobs != last_obs or det != last_det:
-                if len(todslices) != 0:
-                    add_offsets_to_signal(
-                        last_ref, todslices, offset_amplitudes, np.array(itemplates)
-                    )
-                todslices = []
-                itemplates = []
-                last_obs = iobs
-                last_det = det
-                last_ref = signal[iobs, det, :]
-            todslices.append(todslice)
-            itemplates.append(itemplate)
-        if len(todslices) != 0:
+        for iobs, det, todslices, itemplates in self.offset_groups:
             add_offsets_to_signal(
-                last_ref, todslices, offset_amplitudes, np.array(itemplates)
+                signal[iobs, det, :], todslices, offset_amplitudes, itemplates
             )
         return
 
     @function_timer
     def project_signal(self, signal, amplitudes):
         offset_amplitudes = amplitudes[self.name]
-        last_obs = None
-        last_det = None
-        last_ref = None
-        todslices = []
-        itemplates = []
-        for itemplate, iobs, det, todslice, sqsigma in self.offset_templates:
-            if iobs != last_obs or det != last_det:
-                if len(todslices) != 0:
-                    project_signal_offsets(
-                        last_ref, todslices, offset_amplitudes, np.array(itemplates)
-                    )
-                todslices = []
-                itemplates = []
-                last_obs = iobs
-                last_det = det
-                last_ref = signal[iobs, det, :]
-            todslices.append(todslice)
-            itemplates.append(itemplate)
-        if len(todslices) != 0:
+        for iobs, det, todslices, itemplates in self.offset_groups:
             project_signal_offsets(
-                last_ref, todslices, offset_amplitudes, np.array(itemplates)
+                signal[iobs, det, :], todslices, offset_amplitudes, itemplates
             )
         return
 
@@ -550,55 +676,32 @@ class OffsetTemplate(TODTemplate):
             return
         offset_amplitudes_in = amplitudes_in[self.name]
         offset_amplitudes_out = amplitudes_out[self.name]
-        for iobs, obs in enumerate(self.data.obs):
-            tod = obs["tod"]
-            for det in tod.local_dets:
-                slices = self.offset_slices[iobs][det]
-                filters = self.filters[iobs][det]
-                for (offsetslice, sigmasqs), noisefilter in zip(slices, filters):
-                    amps_in = offset_amplitudes_in[offsetslice]
-                    # scipy.signal.convolve will use either `convolve` or `fftconvolve`
-                    # depending on the size of the inputs
-                    amps_out = scipy.signal.convolve(amps_in, noisefilter, mode="same")
-                    offset_amplitudes_out[offsetslice] += amps_out
+        for offsetslice, noisefilter, preconditioner in self.prior_blocks:
+            amps_in = offset_amplitudes_in[offsetslice]
+            amps_out = convolve_kernel_fft(amps_in, noisefilter)
+            offset_amplitudes_out[offsetslice] += amps_out
         return
 
     @function_timer
     def apply_precond(self, amplitudes_in, amplitudes_out):
         offset_amplitudes_in = amplitudes_in[self.name]
         offset_amplitudes_out = amplitudes_out[self.name]
+        # Diagonal preconditioner.  With the noise prior it only remains
+        # for observations without noise information.
+        np.multiply(offset_amplitudes_in, self._sigmasq, out=offset_amplitudes_out)
         if self.use_noise_prior:
             # C_a preconditioner
-            for iobs, obs in enumerate(self.data.obs):
-                tod = obs["tod"]
-                for det in tod.local_dets:
-                    slices = self.offset_slices[iobs][det]
-                    preconditioners = self.preconditioners[iobs][det]
-                    for (offsetslice, sigmasqs), preconditioner in zip(
-                        slices, preconditioners
-                    ):
-                        amps_in = offset_amplitudes_in[offsetslice]
-                        if self.precond_width <= 1:
-                            # Use C_a prior
-                            # scipy.signal.convolve will use either `convolve` or `fftconvolve`
-                            # depending on the size of the inputs
-                            amps_out = scipy.signal.convolve(
-                                amps_in, preconditioner, mode="same"
-                            )
-                        else:
-                            # Use pre-computed Cholesky decomposition
-                            amps_out = scipy.linalg.cho_solve_banded(
-                                preconditioner,
-                                amps_in,
-                                overwrite_b=False,
-                                check_finite=True,
-                            )
-                        offset_amplitudes_out[offsetslice] = amps_out
-        else:
-            # Diagonal preconditioner
-            offset_amplitudes_out[:] = offset_amplitudes_in
-            for itemplate, iobs, det, todslice, sigmasq in self.offset_templates:
-                offset_amplitudes_out[itemplate] *= sigmasq
+            for offsetslice, noisefilter, preconditioner in self.prior_blocks:
+                amps_in = offset_amplitudes_in[offsetslice]
+                if self.precond_width <= 1:
+                    # Use C_a prior
+                    amps_out = convolve_kernel_fft(amps_in, preconditioner)
+                else:
+                    # Use pre-computed Cholesky decomposition
+                    amps_out = scipy.linalg.cho_solve_banded(
+                        preconditioner, amps_in, overwrite_b=False, check_finite=True
+                    )
+                offset_amplitudes_out[offsetslice] = amps_out
         return
 
 
@@ -609,6 +712,8 @@ class TemplateMatrix(TOASTMatrix):
         self.data = data
         self.comm = comm
         self.templates = []
+        # Released amplitude vectors, reused by zero_amplitudes()
+        self._amplitude_pool = []
         for template in templates:
             self.register_template(template)
         return
@@ -658,9 +763,20 @@ class TemplateMatrix(TOASTMatrix):
     def zero_amplitudes(self):
         """ Return a null amplitudes object
         """
-        new_amplitudes = TemplateAmplitudes(self.templates, self.comm)
+        if len(self._amplitude_pool) > 0:
+            new_amplitudes = self._amplitude_pool.pop()
+            new_amplitudes.flatdata.fill(0)
+        else:
+            new_amplitudes = TemplateAmplitudes(self.templates, self.comm)
         return new_amplitudes
 
+    def release_amplitudes(self, amplitudes):
+        """ Return an amplitudes object that is no longer used to the
+        pool drawn from by zero_amplitudes()
+        """
+        self._amplitude_pool.append(amplitudes)
+        return
+
     @function_timer
     def zero_signal(self):
         """ Return a distributed vector of signal set to zero.
@@ -692,7 +808,7 @@ class TemplateMatrix(TOASTMatrix):
         else:
             outsignal = signal.copy()
         template_tod = self.apply(amplitudes)
-        outsignal -= template_tod
+        outsignal.inplace_axpy(-1.0, template_tod)
         # DEBUG begin
         """
         for sig, zorder in [(template_tod, 100), (outsignal, 0)]:
@@ -711,15 +827,32 @@ class TemplateMatrix(TOASTMatrix):
 
 class TemplateAmplitudes(TOASTVector):
     """ TemplateAmplitudes objects hold local and shared template amplitudes
+
+    The amplitudes of all templates live in one contiguous buffer,
+    `flatdata`, so that whole-vector operations are single calls.
+    `amplitudes` holds a view of that buffer for each template.
     """
 
     def __init__(self, templates, comm):
         self.comm = comm
-        self.amplitudes = OrderedDict()
         self.comms = OrderedDict()
+        sizes = OrderedDict()
         for template in templates:
-            self.amplitudes[template.name] = np.zeros(template.namplitude)
+            sizes[template.name] = template.namplitude
             self.comms[template.name] = template.comm
+        self._set_flatdata(np.zeros(sum(sizes.values())), sizes)
+        return
+
+    def _set_flatdata(self, flatdata, sizes):
+        """ Use `flatdata` as the storage and split it into per-template
+        views of the given sizes.
+        """
+        self.flatdata = flatdata
+        self.amplitudes = OrderedDict()
+        offset = 0
+        for name, size in sizes.items():
+            self.amplitudes[name] = self.flatdata[offset : offset + size]
+            offset += size
         return
 
     @function_timer
@@ -733,18 +866,30 @@ class TemplateAmplitudes(TOASTVector):
     def dot(self, other):
         """ Compute the dot product between the two amplitude vectors
         """
-        total = 0
-        for name, values in self.amplitudes.items():
-            dp = np.dot(values, other.amplitudes[name])
-            comm = self.comms[name]
-            if comm is not None:
-                dp = comm.reduce(dp, op=MPI.SUM)
-                if comm.rank != 0:
-                    dp = 0
-            total += dp
+        dots = np.array(
+            [
+                np.dot(values, other.amplitudes[name])
+                for name, values in self.amplitudes.items()
+            ],
+            dtype=np.float64,
+        )
         if self.comm is not None:
-            total = self.comm.allreduce(total, op=MPI.SUM)
-        return total
+            # The template communicators are subsets of `self.comm` so
+            # a single reduction gives the same sum as reducing each
+            # template separately first.
+            self.comm.Allreduce(MPI.IN_PLACE, dots, op=MPI.SUM)
+        else:
+            for i, comm in enumerate(self.comms.values()):
+                if comm is not None:
+                    dots[i] = comm.allreduce(dots[i], op=MPI.SUM)
+        return np.sum(dots)
+
+    @function_timer
+    def local_dot(self, other):
+        """ Compute the dot product between the local parts of the two
+        amplitude vectors.  The caller is responsible for the reduction.
+        """
+        return np.dot(self.flatdata, other.flatdata)
 
     @function_timer
     def __getitem__(self, key):
@@ -752,15 +897,32 @@ class TemplateAmplitudes(TOASTVector):
 
     @function_timer
     def __setitem__(self, key, value):
-        self.amplitudes[name][:] = value
+        self.amplitudes[key][:] = value
         return
 
+    @function_timer
+    def axpy(self, alpha, other):
+        """ Add `alpha` times the provided amplitudes to this one
+        """
+        inplace_axpy(self.flatdata, alpha, other.flatdata)
+        return self
+
+    @function_timer
+    def axpby(self, alpha, beta, other):
+        """ Replace these amplitudes with alpha * self + beta * other
+        """
+        self.flatdata *= alpha
+        inplace_axpy(self.flatdata, beta, other.flatdata)
+        return self
+
     @function_timer
     def copy(self):
         new_amplitudes = TemplateAmplitudes([], self.comm)
-        for name, values in self.amplitudes.items():
-            new_amplitudes.amplitudes[name] = self.amplitudes[name].copy()
-            new_amplitudes.comms[name] = self.comms[name]
+        new_amplitudes.comms = self.comms.copy()
+        sizes = OrderedDict(
+            (name, values.size) for name, values in self.amplitudes.items()
+        )
+        new_amplitudes._set_flatdata(self.flatdata.copy(), sizes)
         return new_amplitudes
 
     @function_timer
@@ -768,11 +930,9 @@ class TemplateAmplitudes(TOASTVector):
         """ Add the provided amplitudes to this one
         """
         if isinstance(other, TemplateAmplitudes):
-            for name, values in self.amplitudes.items():
-                values += other.amplitudes[name]
+            self.flatdata += other.flatdata
         else:
-            for name, values in self.amplitudes.items():
-                values += other
+            self.flatdata += other
         return self
 
     @function_timer
@@ -780,27 +940,23 @@ class TemplateAmplitudes(TOASTVector):
         """ Subtract the provided amplitudes from this one
         """
         if isinstance(other, TemplateAmplitudes):
-            for name, values in self.amplitudes.items():
-                values -= other.amplitudes[name]
+            self.flatdata -= other.flatdata
         else:
-            for name, values in self.amplitudes.items():
-                values -= other
+            self.flatdata -= other
         return self
 
     @function_timer
     def __imul__(self, other):
         """ Scale the amplitudes
         """
-        for name, values in self.amplitudes.items():
-            values *= other
+        self.flatdata *= other
         return self
 
     @function_timer
     def __itruediv__(self, other):
         """ Divide the amplitudes
         """
-        for name, values in self.amplitudes.items():
-            values /= other
+        self.flatdata /= other
         return self
 
 
@@ -838,14 +994,22 @@ class ProjectionMatrix(TOASTMatrix):
         self.flag_mask = flag_mask
 
     @function_timer
-    def apply(self, signal):
+    def apply(self, signal, in_place=False):
         """ Return Z.y
         """
         self.bin_map(signal.name)
-        new_signal = signal.copy()
-        scanned_signal = Signal(self.data, temporary=True, init_val=0)
-        self.scan_map(scanned_signal.name)
-        new_signal -= scanned_signal
+        if in_place:
+            new_signal = signal
+        else:
+            new_signal = signal.copy()
+        # OpSimScan accumulates so scanning the negated map subtracts
+        # P.B.y without a temporary signal.  Restore the sign afterwards so
+        # dist_map holds B.y again.
+        if self.dist_map.data is not None:
+            self.dist_map.data *= -1
+        self.scan_map(new_signal.name)
+        if self.dist_map.data is not None:
+            self.dist_map.data *= -1
         return new_signal
 
     @function_timer
@@ -893,11 +1057,21 @@ class NoiseMatrix(TOASTMatrix):
             new_signal = signal
         else:
             new_signal = signal.copy()
-        for iobs, detweights in enumerate(self.detweights):
-            for det, detweight in detweights.items():
-                new_signal[iobs, det, :] *= detweight
-        # Set flagged samples to zero
-        new_signal.apply_flags(self.common_flag_mask, self.flag_mask)
+        # Weight the signal and set flagged samples to zero in a single
+        # sweep over each detector
+        for iobs, obs in enumerate(new_signal.data.obs):
+            tod = obs["tod"]
+            detweights = self.detweights[iobs]
+            common_flags = tod.local_common_flags()
+            common_flags = (common_flags & self.common_flag_mask) != 0
+            for det in tod.local_dets:
+                ref = tod.local_signal(det, new_signal.name)
+                if det in detweights:
+                    ref *= detweights[det]
+                flags = tod.local_flags(det)
+                flags = (flags & self.flag_mask) != 0
+                flags[common_flags] = True
+                ref[flags] = 0
         # Scale the signal with the weight map
         new_signal.apply_weightmap(self.weightmap)
         return new_signal
@@ -924,12 +1098,16 @@ class Signal(TOASTVector):
             self.name = get_temporary_name()
         else:
             self.name = name
+        # Cache references to the detector signals, keyed by
+        # (iobs, det).  They are dropped before the cache is cleared.
+        self._refs = {}
         if init_val is not None:
             cacheinit = OpCacheInit(name=self.name, init_val=init_val)
             cacheinit.exec(data)
         return
 
     def __del__(self):
+        self._refs.clear()
         if self.temporary:
             cacheclear = OpCacheClear(self.name)
             cacheclear.exec(self.data)
@@ -966,23 +1144,45 @@ class Signal(TOASTVector):
         copysignal.exec(self.data)
         return new_signal
 
+    def _reference(self, iobs, det):
+        """ Return a reference to the full TOD cache of one detector
+        """
+        key = (iobs, det)
+        ref = self._refs.get(key)
+        if ref is None:
+            tod = self.data.obs[iobs]["tod"]
+            ref = tod.local_signal(det, self.name)
+            self._refs[key] = ref
+        return ref
+
     @function_timer
     def __getitem__(self, key):
         """ Return a reference to a slice of TOD cache
         """
         iobs, det, todslice = key
-        tod = self.data.obs[iobs]["tod"]
-        return tod.local_signal(det, self.name)[todslice]
+        return self._reference(iobs, det)[todslice]
 
     @function_timer
     def __setitem__(self, key, value):
         """ Set slice of TOD cache
         """
         iobs, det, todslice = key
-        tod = self.data.obs[iobs]["tod"]
-        tod.local_signal(det, self.name)[todslice] = value
+        self._reference(iobs, det)[todslice] = value
         return
 
+    @function_timer
+    def inplace_axpy(self, alpha, other):
+        """ Add `alpha` times the provided Signal object to this one
+        in a single pass over each detector.
+        """
+        for iobs, obs in enumerate(self.data.obs):
+            tod = obs["tod"]
+            for det in tod.local_dets:
+                inplace_axpy(
+                    self._reference(iobs, det), alpha, other._reference(iobs, det)
+                )
+        return self
+
     @function_timer
     def __iadd__(self, other):
         """ Add the provided Signal object to this one
@@ -990,10 +1190,11 @@ class Signal(TOASTVector):
         for iobs, obs in enumerate(self.data.obs):
             tod = obs["tod"]
             for det in tod.local_dets:
+                ref = self._reference(iobs, det)
                 if isinstance(other, Signal):
-                    self[iobs, det, :] += other[iobs, det, :]
+                    ref += other._reference(iobs, det)
                 else:
-                    self[iobs, det, :] += other
+                    ref += other
         return self
 
     @function_timer
@@ -1003,10 +1204,11 @@ class Signal(TOASTVector):
         for iobs, obs in enumerate(self.data.obs):
             tod = obs["tod"]
             for det in tod.local_dets:
+                ref = self._reference(iobs, det)
                 if isinstance(other, Signal):
-                    self[iobs, det, :] -= other[iobs, det, :]
+                    ref -= other._reference(iobs, det)
                 else:
-                    self[iobs, det, :] -= other
+                    ref -= other
         return self
 
     @function_timer
@@ -1016,7 +1218,8 @@ class Signal(TOASTVector):
         for iobs, obs in enumerate(self.data.obs):
             tod = obs["tod"]
             for det in tod.local_dets:
-                self[iobs, det, :] *= other
+                ref = self._reference(iobs, det)
+                ref *= other
         return self
 
     @function_timer
@@ -1026,7 +1229,8 @@ class Signal(TOASTVector):
         for iobs, obs in enumerate(self.data.obs):
             tod = obs["tod"]
             for det in tod.local_dets:
-                self[iobs, det, :] /= other
+                ref = self._reference(iobs, det)
+                ref /= other
         return self
 
 
@@ -1044,6 +1248,8 @@ class PCGSolver:
         niter_min=3,
         niter_max=100,
         convergence_limit=1e-12,
+        report_interval=1,
+        residual_replacement=50,
     ):
         self.comm = comm
         if comm is None:
@@ -1057,23 +1263,54 @@ class PCGSolver:
         self.niter_min = niter_min
         self.niter_max = niter_max
         self.convergence_limit = convergence_limit
-
+        # Report the relative residual every report_interval iterations
+        self.report_interval = max(1, report_interval)
+        # Replace the recursively updated residual with the true residual
+        # every residual_replacement iterations
+        self.residual_replacement = max(1, residual_replacement)
+
+        # The projected signal is already a copy so the noise weighting
+        # can be applied in place
         self.rhs = self.templates.apply_transpose(
-            self.noise.apply(self.projection.apply(self.signal))
+            self.noise.apply(self.projection.apply(self.signal), in_place=True)
         )
         # print("RHS {}: {}".format(self.signal.name, self.rhs))  # DEBUG
+        # Persistent solver vectors, reused across calls to solve()
+        self._residual = self.templates.zero_amplitudes()  # r
+        self._proposal = self.templates.zero_amplitudes()  # p
+        self._lhs_proposal = self.templates.zero_amplitudes()  # s = A.p
         return
 
     @function_timer
     def apply_lhs(self, amplitudes):
         """ Return A.x
         """
-        new_amplitudes = self.templates.apply_transpose(
-            self.noise.apply(self.projection.apply(self.templates.apply(amplitudes)))
-        )
+        # The template signal is a temporary so the projection and noise
+        # weighting are applied to it in place
+        signal = self.templates.apply(amplitudes)
+        self.projection.apply(signal, in_place=True)
+        self.noise.apply(signal, in_place=True)
+        new_amplitudes = self.templates.apply_transpose(signal)
+        del signal
         self.templates.add_prior(amplitudes, new_amplitudes)
         return new_amplitudes
 
+    @function_timer
+    def start_global_dots(self, *pairs):
+        """ Start reducing the dot products of the given pairs of
+        amplitude vectors across all processes.
+
+        Returns the buffer of dot products and the request that must
+        complete before the buffer is read.  The request is None when
+        there is nothing to reduce.
+        """
+        dots = np.array([x.local_dot(y) for x, y in pairs], dtype=np.float64)
+        if self.comm is None:
+            request = None
+        else:
+            request = self.comm.Iallreduce(MPI.IN_PLACE, dots, op=MPI.SUM)
+        return dots, request
+
     @function_timer
     def solve(self):
         """ Standard issue PCG solution of A.x = b
@@ -1088,60 +1325,141 @@ class PCGSolver:
         timer.start()
         # Initial guess is zero amplitudes
         guess = self.templates.zero_amplitudes()
+        if self.niter_max < 1:
+            return guess
         # print("guess:", guess)  # DEBUG
         # print("RHS:", self.rhs)  # DEBUG
-        residual = self.rhs.copy()
-        # print("residual(1):", residual)  # DEBUG
-        residual -= self.apply_lhs(guess)
-        # print("residual(2):", residual)  # DEBUG
-        precond_residual = self.templates.apply_precond(residual)
-        proposal = precond_residual.copy()
-        sqsum = precond_residual.dot(residual)
-        init_sqsum, best_sqsum, last_best = sqsum, sqsum, sqsum
-        if self.rank == 0:
-            log.info("Initial residual: {}".format(init_sqsum))
-        # Iterate to convergence
-        for iiter in range(self.niter_max):
-            if not np.isfinite(sqsum):
+        # The guess is zero so A.x vanishes and the initial residual is
+        # just the RHS
+        residual = self._residual
+        np.copyto(residual.flatdata, self.rhs.flatdata)
+        # print("residual:", residual)  # DEBUG
+        # This is the pipelined PCG of Ghysels & Vanroose (2014): the
+        # single reduction of each iteration is overlapped with the
+        # application of the preconditioner and A.  Letters in the
+        # comments follow the paper.
+        precond_residual = self.templates.apply_precond(residual)  # u
+        lhs = self.apply_lhs(precond_residual)  # w
+        proposal = self._proposal  # p
+        lhs_proposal = self._lhs_proposal  # s = A.p
+        precond_lhs_proposal = None  # q = M.s
+        lhs_precond_lhs_proposal = None  # z = A.q
+        precond_lhs = None  # m
+        lhs_precond_lhs = None  # n
+        # Iterate to convergence.  The first pass only completes the
+        # initial reduction.  Pass `iiter` checks the residual of update
+        # `iiter` and, unless it is the last pass, makes the next update.
+        for iiter in range(-1, self.niter_max):
+            last_pass = iiter == self.niter_max - 1
+            if iiter > 0 and iiter % self.residual_replacement == 0 and not last_pass:
+                # Rounding errors accumulate in the recursively updated
+                # vectors.  Replace them with their true values.
+                lhs_guess = self.apply_lhs(guess)
+                np.copyto(residual.flatdata, self.rhs.flatdata)
+                residual.axpy(-1, lhs_guess)
+                self.templates.release_amplitudes(lhs_guess)
+                true_lhs_proposal = self.apply_lhs(proposal)
+                np.copyto(lhs_proposal.flatdata, true_lhs_proposal.flatdata)
+                self.templates.release_amplitudes(true_lhs_proposal)
+                for amplitudes in [
+                    precond_residual,
+                    lhs,
+                    precond_lhs_proposal,
+                    lhs_precond_lhs_proposal,
+                ]:
+                    self.templates.release_amplitudes(amplitudes)
+                precond_residual = self.templates.apply_precond(residual)
+                lhs = self.apply_lhs(precond_residual)
+                precond_lhs_proposal = self.templates.apply_precond(lhs_proposal)
+                lhs_precond_lhs_proposal = self.apply_lhs(precond_lhs_proposal)
+            dots, request = self.start_global_dots(
+                (precond_residual, residual), (precond_residual, lhs)
+            )
+            if not last_pass:
+                precond_lhs = self.templates.apply_precond(lhs)
+                lhs_precond_lhs = self.apply_lhs(precond_lhs)
+            if request is not None:
+                request.Wait()
+            # Plain floats keep the scalar bookkeeping below cheap
+            sqsum, delta = dots.tolist()
+            # Check every pass, before either value is used as a divisor
+            if not (math.isfinite(sqsum) and math.isfinite(delta)):
                 raise RuntimeError("Residual is not finite")
-            alpha = sqsum
-            alpha /= proposal.dot(self.apply_lhs(proposal))
-            alpha_proposal = proposal.copy()
-            alpha_proposal *= alpha
-            guess += alpha_proposal
-            residual -= self.apply_lhs(alpha_proposal)
-            del alpha_proposal
-            # Prepare for next iteration
-            precond_residual = self.templates.apply_precond(residual)
-            beta = 1 / sqsum
-            # Check for convergence
-            sqsum = precond_residual.dot(residual)
-            if self.rank == 0:
-                timer.report_clear(
-                    "Iter = {:4} relative residual: {:12.4e}".format(
-                        iiter, sqsum / init_sqsum
-                    )
-                )
-            if sqsum < init_sqsum * self.convergence_limit or sqsum < 1e-30:
+            if iiter < 0:
+                init_sqsum, best_sqsum, last_best = sqsum, sqsum, sqsum
                 if self.rank == 0:
-                    timer0.report_clear(
-                        "PCG converged after {} iterations".format(iiter)
-                    )
-                break
-            best_sqsum = min(sqsum, best_sqsum)
-            if iiter % 10 == 0 and iiter >= self.niter_min:
-                if last_best < best_sqsum * 2:
+                    log.info("Initial residual: {}".format(init_sqsum))
+                if init_sqsum < 1e-30:
+                    # Nothing to solve
+                    break
+            else:
+                if iiter % self.report_interval == 0:
+                    if self.rank == 0:
+                        timer.report_clear(
+                            "Iter = {:4} relative residual: {:12.4e}".format(
+                                iiter, sqsum / init_sqsum
+                            )
+                        )
+                # Check for convergence
+                if sqsum < init_sqsum * self.convergence_limit or sqsum < 1e-30:
                     if self.rank == 0:
                         timer0.report_clear(
-                            "PCG stalled after {} iterations".format(iiter)
+                            "PCG converged after {} iterations".format(iiter)
                         )
                     break
-                last_best = best_sqsum
+                best_sqsum = min(sqsum, best_sqsum)
+                if iiter % 10 == 0 and iiter >= self.niter_min:
+                    if last_best < best_sqsum * 2:
+                        if self.rank == 0:
+                            timer0.report_clear(
+                                "PCG stalled after {} iterations".format(iiter)
+                            )
+                        break
+                    last_best = best_sqsum
+            if last_pass:
+                break
             # Select the next direction
-            beta *= sqsum
-            proposal *= beta
-            proposal += precond_residual
-        log.info("{} : Solution: {}".format(self.rank, guess))  # DEBUG
+            if precond_lhs_proposal is None:
+                denominator = delta
+            else:
+                beta = sqsum / last_sqsum
+                denominator = delta - beta * sqsum / alpha
+            if denominator == 0 or not math.isfinite(denominator):
+                raise RuntimeError(
+                    "PCG broke down after {} iterations".format(iiter + 1)
+                )
+            alpha = sqsum / denominator
+            if precond_lhs_proposal is None:
+                np.copyto(proposal.flatdata, precond_residual.flatdata)
+                np.copyto(lhs_proposal.flatdata, lhs.flatdata)
+                precond_lhs_proposal = precond_lhs
+                lhs_precond_lhs_proposal = lhs_precond_lhs
+            else:
+                proposal.axpby(beta, 1, precond_residual)
+                lhs_proposal.axpby(beta, 1, lhs)
+                precond_lhs_proposal.axpby(beta, 1, precond_lhs)
+                lhs_precond_lhs_proposal.axpby(beta, 1, lhs_precond_lhs)
+                self.templates.release_amplitudes(precond_lhs)
+                self.templates.release_amplitudes(lhs_precond_lhs)
+            precond_lhs = None
+            lhs_precond_lhs = None
+            last_sqsum = sqsum
+            guess.axpy(alpha, proposal)
+            residual.axpy(-alpha, lhs_proposal)
+            precond_residual.axpy(-alpha, precond_lhs_proposal)
+            lhs.axpy(-alpha, lhs_precond_lhs_proposal)
+        # Return the temporaries to the pool
+        for amplitudes in [
+            precond_residual,
+            lhs,
+            precond_lhs,
+            lhs_precond_lhs,
+            precond_lhs_proposal,
+            lhs_precond_lhs_proposal,
+        ]:
+            if amplitudes is not None:
+                self.templates.release_amplitudes(amplitudes)
+        # log.info("{} : Solution: {}".format(self.rank, guess))  # DEBUG
         return guess
 
 
@@ -1176,6 +1494,7 @@ class OpMapMaker(Operator):
         subharmonic_order=None,
         iter_min=3,
         iter_max=100,
+        report_interval=1,
         use_noise_prior=True,
         precond_width=20,
         pixels="pixels",
@@ -1205,6 +1524,8 @@ class OpMapMaker(Operator):
         self.subharmonic_order = subharmonic_order
         self.iter_min = iter_min
         self.iter_max = iter_max
+        # Report the PCG residual every report_interval iterations
+        self.report_interval = report_interval
         self.use_noise_prior = use_noise_prior
         self.precond_width = precond_width
         self.pixels = pixels
@@ -1437,6 +1758,7 @@ class OpMapMaker(Operator):
             signal,
             niter_min=self.iter_min,
             niter_max=self.iter_max,
+            report_interval=self.report_interval,
         )
         if self.rank == 0:
             timer.report_clear("Initialize PCG solver")
@@ -1460,7 +1782,15 @@ class OpMapMaker(Operator):
         if self.rank == 0:
             timer.report_clear("Read processing mask from {}".format(self.maskfile))
 
-        scanmask = OpScanMask(distmap=distmap, flagmask=self.mask_bit)
+        # The mask is binary, store it as one byte per pixel.  Only values
+        # below 0.5 are masked, so NaN pixels remain usable exactly as when
+        # the float map is scanned.
+        mask = DistPixels(data, comm=self.comm, nnz=1, dtype=np.uint8)
+        if mask.data is not None:
+            mask.data[:] = np.logical_not(distmap.data < 0.5)
+        del distmap
+
+        scanmask = OpScanMask(distmap=mask, flagmask=self.mask_bit)
         scanmask.exec(data)
 
         if self.rank == 0:
@@ -1548,8 +1878,6 @@ class OpMapMaker(Operator):
         timer = Timer()
 
         dist_map = DistPixels(data, comm=self.comm, nnz=self.nnz, dtype=np.float64)
-        if dist_map.data is not None:
-            dist_map.data.fill(0.0)
         # FIXME: OpAccumDiag should support separate detweights for each observation
         build_dist_map = OpAccumDiag(
             zmap=dist_map,
@@ -1590,19 +1918,31 @@ class OpMapMaker(Operator):
             else:
                 noise = None
             detweights = {}
-            for det in tod.local_dets:
-                if noise is None:
-                    noisevar = 1
-                else:
-                    # Determine an approximate white noise level,
-                    # accounting for the fact that the PSD may have a
-                    # transfer function roll-off near Nyquist
+            if noise is None:
+                for det in tod.local_dets:
+                    detweights[det] = 1
+            else:
+                # Determine an approximate white noise level,
+                # accounting for the fact that the PSD may have a
+                # transfer function roll-off near Nyquist.
+                # Detectors that share the frequency grid and sample
+                # rate are processed together.
+                groups = OrderedDict()
+                for det in tod.local_dets:
                     freq = noise.freq(det)
-                    psd = noise.psd(det)
                     rate = noise.rate(det)
+                    key = (rate, freq.tobytes())
+                    if key not in groups:
+                        groups[key] = (freq, rate, [])
+                    groups[key][2].append(det)
+                for freq, rate, dets in groups.values():
                     ind = np.logical_and(freq > rate * 0.2, freq < rate * 0.4)
-                    noisevar = np.median(psd[ind])
-                detweights[det] = 1 / noisevar
+                    psds = np.vstack([noise.psd(det)[ind] for det in dets])
+                    noisevars = np.median(psds, axis=1)
+                    for det, noisevar in zip(dets, noisevars):
+                        detweights[det] = 1 / noisevar
+                # Keep the detector order
+                detweights = {det: detweights[det] for det in tod.local_dets}
             self.detweights.append(detweights)
         if self.rank == 0:
             timer.report_clear("Get detector weights")
@@ -1623,12 +1963,8 @@ class OpMapMaker(Operator):
         self.white_noise_cov_matrix = DistPixels(
             data, comm=self.comm, nnz=self.ncov, dtype=np.float64
         )
-        if self.white_noise_cov_matrix.data is not None:
-            self.white_noise_cov_matrix.data.fill(0.0)
 
         hits = DistPixels(data, comm=self.comm, nnz=1, dtype=np.int64)
-        if hits.data is not None:
-            hits.data.fill(0)
 
         # compute the hits and covariance once, since the pointing and noise
         # weights are fixed.
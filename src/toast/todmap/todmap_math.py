@@ -423,7 +423,10 @@ class OpScanMask(Operator):
     Local pixels should already exist.
 
     Args:
-        distmap (DistPixels): the distributed mask.
+        distmap (DistPixels): the distributed mask.  A uint8 mask is
+            looked up directly and zero pixels are flagged.  Other types
+            are scanned as float maps and values below 0.5 are flagged,
+            so NaN pixels are not.
         pixels (str): the name of the cache object (<pixels>_<detector>)
             containing the pixel indices to use.
         name (str): scale data in cache with name <name>_<detector>.
@@ -455,15 +458,24 @@ class OpScanMask(Operator):
                 pixels = tod.cache.reference(pixelsname)
                 nsamp = pixels.size
                 sm, lpix = self.map.global_to_local(pixels)
+                flags = tod.local_flags(det, self.flags)
 
                 maptype = np.dtype(self.map.dtype)
+                if maptype == np.uint8:
+                    # Binary mask: a plain lookup is enough.  Samples
+                    # outside the local pixels are flagged, as in the scan.
+                    good = np.logical_and(sm >= 0, lpix >= 0)
+                    masktod = np.zeros(nsamp, dtype=np.uint8)
+                    masktod[good] = self.map.data[sm[good], lpix[good], 0]
+                    flags[masktod == 0] |= self.flagmask
+                    continue
                 if maptype.char == "d":
                     scan_map = scan_map_float64
                 elif maptype.char == "f":
                     scan_map = scan_map_float32
                 else:
                     raise RuntimeError(
-                        "Scanning weights from a map only supports float32 and float64 maps"
+                        "Scanning a mask only supports uint8, float32 and float64 maps"
                     )
                 # We pass the signal to be scaled in place of the pointing weights
                 # The returned TOD is already TOD x weigths
@@ -478,7 +490,6 @@ class OpScanMask(Operator):
                     weights,
                     masktod,
                 )
-                flags = tod.local_flags(det, self.flags)
                 flags[masktod < 0.5] |= self.flagmask
         return
 